@@ -18,16 +18,24 @@ By: Pawel Toborek (20 Aug 2025)
 """
 
 from __future__ import annotations
+import bisect
+import heapq
+import itertools
+import math
 import os
 import json
+import re
 import sqlite3
+import sys
 import threading
 import time
-from datetime import datetime, timedelta, date, timezone
+from collections import deque
+from datetime import datetime, timedelta, date, timezone, time as dtime
 from pathlib import Path
 from typing import Any, Dict, List, Optional
 
 from flask import Flask, request, jsonify, session, send_from_directory, abort
+from flask.json.provider import DefaultJSONProvider
 from werkzeug.security import generate_password_hash, check_password_hash
 
 # ---------------------------- Optional sound effects ----------------------------
@@ -60,6 +68,20 @@ try:
 except Exception:  # pragma: no cover
     serial = None  # type: ignore
 
+# Faster JSON parsing for request bodies; stdlib json otherwise.
+try:
+    import orjson  # type: ignore
+    _json_loads = orjson.loads
+except Exception:  # pragma: no cover
+    orjson = None  # type: ignore
+    _json_loads = json.loads
+
+# Production WSGI server; fall back to the Werkzeug dev server if not installed.
+try:
+    from waitress import serve  # type: ignore
+except Exception:  # pragma: no cover
+    serve = None  # type: ignore
+
 APP_ROOT = Path(__file__).parent.resolve()
 DB_PATH = APP_ROOT / "demo.db"
 CARTRIDGES_DIR = APP_ROOT / "cartridges"
@@ -69,34 +91,60 @@ LOGS_MAX_LINES = 2000
 app = Flask(__name__, static_folder=str(APP_ROOT / "static"), static_url_path="/static")
 app.config.update(SECRET_KEY=os.environ.get("FLASK_SECRET", "dev-secret-key"))
 
+
+class ORJSONProvider(DefaultJSONProvider):
+    """jsonify() via orjson; falls back to Flask's default() for types orjson lacks."""
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+
+if orjson is not None:
+    app.json = ORJSONProvider(app)
+
 # ---------------------------- In-memory runtime state ----------------------------
-state_lock = threading.RLock()
+# Keep critical sections short and never hold a lock across serial I/O.
+cartridge_lock = threading.Lock()  # cartridge_data (and its schedule entries)
 
 serial_port = "/dev/serial0"
 serial_baud = 115200
 ser: Optional["serial.Serial"] = None
 
-serial_logs: List[str] = []  # rolling memory log
+# Rolling memory log; bounded deque trims itself and append is atomic, so no lock
+serial_logs: deque = deque(maxlen=LOGS_MAX_LINES)
 
 default_mem_size = 256
 memory = bytearray(default_mem_size)
+_last_cid_bytes = bytes(8)  # raw bytes behind cartridge_id, to skip re-hexing unchanged IDs
+_mem_loaded = threading.Event()  # set by the serial reader after each parsed $MEM line
+# Written only by the serial reader; str rebinding is atomic, so readers need no lock
 cartridge_id = "0000000000000000"
 cartridge_id_old = "0000000000000000"
 cartridge_data: Dict[str, Any] = {}
-events: List[Dict[str, Any]] = []
+events: deque = deque(maxlen=2000)  # bounded like serial_logs; append needs no lock
 
-# Track whether we're currently showing TAKE_PILL screen to avoid spamming the device
-showing_take_pill = False
+# Change counters behind the ETags of /api/schedule and /api/events. next() on
+# itertools.count is atomic, and the boot id keeps ETags unique across restarts.
+_BOOT_ID = os.urandom(4).hex()
+_schedule_seq = itertools.count(1)
+_schedule_version = 0  # bumped under cartridge_lock whenever the schedule changes
+_events_seq = itertools.count(1)
+_events_version = 0
+
+# Track whether we're currently showing TAKE_PILL screen to avoid spamming the device.
+# threading.Event gives atomic set/clear/is_set without taking cartridge_lock.
+showing_take_pill = threading.Event()
 
 # ---------------------------- Utilities ----------------------------
 
 def log_line(s: str) -> None:
-    with state_lock:
-        ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        serial_logs.append(f"[{ts}] {s}")
-        # Trim rolling log without rebinding the list
-        if len(serial_logs) > LOGS_MAX_LINES:
-            del serial_logs[: len(serial_logs) - LOGS_MAX_LINES]
+    serial_logs.append(f"[{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())}] {s}")
 
 
 def now_local() -> datetime:
@@ -108,13 +156,42 @@ def iso_date(d: date) -> str:
 
 # ---------------------------- Serial I/O ----------------------------
 
+ASYNC_LOW_LATENCY = 1 << 13  # linux/tty_flags.h
+_SERIAL_FLAGS_OFFSET = 16     # serial_struct: int type, line; unsigned port; int irq; int flags
+
+
+def _set_low_latency(fd: int) -> bool:
+    """Set ASYNC_LOW_LATENCY on a Linux UART so the driver pushes RX bytes to the tty
+    immediately instead of batching them. Returns False where unsupported.
+    """
+    try:
+        import fcntl
+        import struct
+        import termios
+        tiocgserial = getattr(termios, "TIOCGSERIAL", 0x541E)
+        tiocsserial = getattr(termios, "TIOCSSERIAL", 0x541F)
+        buf = bytearray(fcntl.ioctl(fd, tiocgserial, bytes(128)))
+        (flags,) = struct.unpack_from("i", buf, _SERIAL_FLAGS_OFFSET)
+        if not flags & ASYNC_LOW_LATENCY:
+            struct.pack_into("i", buf, _SERIAL_FLAGS_OFFSET, flags | ASYNC_LOW_LATENCY)
+            fcntl.ioctl(fd, tiocsserial, bytes(buf))
+        return True
+    except Exception:  # non-Linux, or driver without TIOCSSERIAL support
+        return False
+
+
 def init_serial() -> None:
     global ser
     if serial is None:
         log_line("pyserial not available; running in no-serial mode")
         return
     try:
-        ser = serial.Serial(serial_port, serial_baud, timeout=0.1)  # non-blocking
+        ser = serial.Serial(serial_port, serial_baud, timeout=0.2)  # reads block up to 200 ms
+        if hasattr(ser, "set_buffer_size"):  # Windows-only in pyserial
+            ser.set_buffer_size(rx_size=8192)
+        fd = getattr(ser, "fd", None)
+        if fd is not None and _set_low_latency(fd):
+            log_line("Serial low_latency enabled")
         log_line(f"Opened serial {serial_port} @ {serial_baud}")
     except Exception as e:  # pragma: no cover
         ser = None
@@ -138,27 +215,95 @@ def send_serial(cmd: str) -> None:
 
 def parse_mem_line(line: str) -> None:
     """Parse lines like: $MEM 0x10: FF FF ... and update memory + cartridge id."""
-    global cartridge_id, cartridge_id_old
+    global cartridge_id, cartridge_id_old, _last_cid_bytes
+    parsed = False
     try:
         parts = line.split()
         # Expect: $MEM 0x10: FF FF ...
         address_str = parts[1].rstrip(':')
         start_addr = int(address_str, 16)
-        hex_bytes = parts[2:]
-        for i, hb in enumerate(hex_bytes):
-            idx = start_addr + i
-            if 0 <= idx < len(memory):
-                memory[idx] = int(hb, 16)
+        # Decode the whole run in one C call and copy it in with a single slice
+        buf = bytes.fromhex(" ".join(parts[2:]))
+        if 0 <= start_addr < len(memory):
+            end = min(start_addr + len(buf), len(memory))
+            memory[start_addr:end] = buf[:end - start_addr]
+        parsed = True
     except Exception as e:
         print(f"⚠️ Error parsing data: {line} -> {e}")
     # First 8 bytes of memory contain the cartridge ID
-    new_cid = memory[:8].hex().upper()
-    if new_cid != cartridge_id:
-        cartridge_id = new_cid
-        if cartridge_id != cartridge_id_old:
-            cartridge_id_old = cartridge_id
-            print(f"Loading cartridge {cartridge_id}!")
-            load_cartridge_json(cartridge_id)
+    cid_bytes = bytes(memory[:8])
+    if cid_bytes != _last_cid_bytes:
+        _last_cid_bytes = cid_bytes
+        new_cid = cid_bytes.hex().upper()
+        if new_cid != cartridge_id:
+            cartridge_id = new_cid
+            if cartridge_id != cartridge_id_old:
+                cartridge_id_old = cartridge_id
+                print(f"Loading cartridge {cartridge_id}!")
+                load_cartridge_json(cartridge_id)
+    if parsed:
+        # Wake a request waiting in /api/cartridge for a fresh memory read
+        _mem_loaded.set()
+
+
+def _play(sound: Any) -> None:
+    if sound:
+        try:
+            sound.play()
+        except Exception:
+            pass
+
+
+# ---- $-prefixed commands: handler returns True when the line is fully consumed ----
+
+def _handle_mem(parts: List[str], data: str) -> bool:
+    parse_mem_line(data)
+    return True
+
+
+def _handle_screen(parts: List[str], data: str) -> bool:
+    screen = parts[1] if len(parts) > 1 else ''
+    print(f"Screen updated to {screen}")
+    return False
+
+
+_CMD_PREFIX = {
+    "$MEM": _handle_mem,
+    "$screen": _handle_screen,
+}
+
+# ---- Substring triggers (checked in this order, each at most once per line) ----
+
+def _on_button(data: str) -> None:
+    if sound_alarm:
+        try:
+            sound_alarm.stop()
+        except Exception:
+            pass
+    _play(sound_btn_short)
+    if "OK" in data:
+        # Attempt to dispense pills for the currently ACTIVE schedule entry
+        try:
+            handle_ok_button_dispense()
+        except Exception as e:  # pragma: no cover
+            log_line(f"Error during OK dispense: {e}")
+    elif "BACK long press" in data:
+        send_serial('mem -r 0 f')
+
+
+def _on_mcu_init(data: str) -> None:
+    log_line(f"WARNING: Microcontroller reset, pooling cartridge ID...")
+    send_serial("mem -r 0 f")
+
+
+_TRIGGERS = {
+    "Button": _on_button,
+    "drp ok": lambda data: _play(sound_success),
+    "drp fail": lambda data: _play(sound_error),
+    "screen ERROR": lambda data: _play(sound_error),
+    "init": _on_mcu_init,
+}
+_TRIGGER_RE = re.compile("|".join(map(re.escape, _TRIGGERS)))
 
 
 def process_serial_command(data: str) -> None:
@@ -166,90 +311,54 @@ def process_serial_command(data: str) -> None:
     if not data or not data.startswith('$'):
         return
     # print(f"Serial received : {data}")
-    if data.startswith("$MEM"):
-        parse_mem_line(data)
+    parts = data.split(None, 2)
+    handler = _CMD_PREFIX.get(parts[0])
+    if handler and handler(parts, data):
         return
-    if data.startswith("$screen"):
-        screen = data.split(' ')[1] if ' ' in data else ''
-        print(f"Screen updated to {screen}")
-    if "Button" in data:
-        if sound_alarm:
-            try:
-                sound_alarm.stop()
-            except Exception:
-                pass
-        if sound_btn_short:
-            try:
-                sound_btn_short.play()
-            except Exception:
-                pass
-        if "OK" in data:
-            # Attempt to dispense pills for the currently ACTIVE schedule entry
-            try:
-                handle_ok_button_dispense()
-            except Exception as e:  # pragma: no cover
-                log_line(f"Error during OK dispense: {e}")
-        elif "BACK long press" in data:
-            send_serial('mem -r 0 f')
-    if "drp ok" in data:
-        if sound_success:
-            try:
-                sound_success.play()
-            except Exception:
-                pass
-    if "drp fail" in data:
-        if sound_error:
-            try:
-                sound_error.play()
-            except Exception:
-                pass
-    if "screen ERROR" in data:
-        if sound_error:
-            try:
-                sound_error.play()
-            except Exception:
-                pass
-    if "init" in data:
-        log_line(f"WARNING: Microcontroller reset, pooling cartridge ID...")
-        send_serial("mem -r 0 f")
+    # One regex pass finds every trigger instead of one `in` scan per trigger
+    hits = set(_TRIGGER_RE.findall(data))
+    if not hits:
+        return
+    for key, on_trigger in _TRIGGERS.items():
+        if key in hits:
+            on_trigger(data)
 
 
 def serial_reader_thread() -> None:
     """Continuously read from serial, process complete lines when a newline is seen."""
-    buf = b""
+    buf = bytearray()
     while True:
         try:
             if ser is not None and getattr(ser, "read", None):
-                chunk = ser.read(128)
+                # Block for the first byte (up to the port timeout), then drain whatever
+                # the driver already has in one call instead of many small reads.
+                chunk = ser.read(max(1, ser.in_waiting))
             else:
                 # In demo/no-serial mode, sleep a bit and continue
                 time.sleep(0.25)
                 continue
             if not chunk:
-                time.sleep(0.01)
                 continue
             buf += chunk
-            while b"\n" in buf:
-                line, buf = buf.split(b"\n", 1)
-                try:
-                    s = line.decode("utf-8", errors="replace").rstrip("\r")
-                except Exception:  # pragma: no cover
-                    s = repr(line)
+            start = 0
+            while True:
+                nl = buf.find(b"\n", start)
+                if nl < 0:
+                    break
+                s = buf[start:nl].decode("utf-8", errors="replace").rstrip("\r")
+                start = nl + 1
                 process_serial_command(s)
                 log_line(f"RX: {s}")
+            if start:
+                del buf[:start]
         except Exception as e:  # pragma: no cover
             log_line(f"Serial read error: {e}")
             time.sleep(0.5)
 
 
-def serial_heartbeat_thread() -> None:
-    while True:
-        try:
-            now = datetime.now()
-            send_serial(f"time {now:%H} {now:%M} {now:%S}")
-        except Exception as e:  # pragma: no cover
-            log_line(f"Heartbeat error: {e}")
-        time.sleep(10)  # every 10s
+def heartbeat_send() -> None:
+    """Push the local time to the device (run every 10 s by timer_thread)."""
+    send_serial(time.strftime("time %H %M %S"))
 
 
 # ---------------------------- Scheduling ----------------------------
@@ -266,58 +375,84 @@ def current_cycle_day(start_date: date, repeat_days: int) -> int:
     return day_in_cycle
 
 
-def within_window(now: datetime, t_start: datetime, t_end: datetime) -> int:
-    """Return -1 if before, 0 if in window, +1 if after (for a given day)."""
-    if now < t_start:
-        return -1
-    if now > t_end:
-        return 1
-    return 0
-
-
 def emit_event(kind: str, payload: Optional[Dict[str, Any]] = None) -> None:
-    with state_lock:
-        events.append({
-            "ts": datetime.now().isoformat(timespec="seconds"),
-            "kind": kind,
-            "payload": payload or {},
-        })
-        # Keep events reasonable; avoid rebinding the list
-        if len(events) > 2000:
-            del events[: len(events) - 1000]
+    global _events_version
+    events.append({
+        "ts": datetime.now().isoformat(timespec="seconds"),
+        "kind": kind,
+        "payload": payload or {},
+    })
+    _events_version = next(_events_seq)
 
 
-def _parse_iso_utc(dt_str: str) -> datetime:
-    # Expecting Z suffix (UTC)
-    if dt_str.endswith('Z'):
-        dt_str = dt_str[:-1] + '+00:00'
-    return datetime.fromisoformat(dt_str).astimezone(timezone.utc)
+def _schedule_changed() -> None:
+    """Invalidate the /api/schedule ETag. Caller must hold cartridge_lock."""
+    global _schedule_version
+    _schedule_version = next(_schedule_seq)
 
 
-def _get_schedule_list() -> List[Dict[str, Any]]:
-    return list(cartridge_data.get("schedule", []))
+def _snapshot_schedule() -> List[Dict[str, Any]]:
+    """Copy of the schedule safe to serialize after cartridge_lock is released.
+    Entries are copied too, since the scheduler/OK handler mutate them in place;
+    private keys (e.g. cached _start_utc/_end_utc datetimes) are left out.
+    Caller must hold cartridge_lock.
+    """
+    return [{k: v for k, v in e.items() if not k.startswith('_')} for e in cartridge_data.get("schedule", [])]
 
 
 def _set_schedule_list(new_list: List[Dict[str, Any]]) -> None:
     cartridge_data["schedule"] = new_list
 
 
+# Sorted-by-start view of cartridge_data["schedule"], rebuilt whenever the list object
+# is replaced (cartridge load/activation). Guarded by cartridge_lock.
+_sched_idx: Dict[str, Any] = {"sched": None}
+
+
+def _schedule_index() -> Dict[str, Any]:
+    """Return the index for the current schedule, (re)building it if needed:
+    - entries: schedule entries with cached UTC datetimes, sorted by _start_utc
+    - starts: their _start_utc values, for bisect
+    - max_window: longest window, bounds how far back an open window can start
+    - active: positions of ACTIVE entries (maintained by schedule_tick)
+    Caller must hold cartridge_lock.
+    """
+    global _sched_idx
+    sched = cartridge_data.get("schedule") or []
+    if _sched_idx["sched"] is not sched:
+        entries = sorted(
+            (e for e in sched if e.get("_start_utc") is not None and e.get("_end_utc") is not None),
+            key=lambda e: e["_start_utc"],
+        )
+        _sched_idx = {
+            "sched": sched,
+            "entries": entries,
+            "starts": [e["_start_utc"] for e in entries],
+            "max_window": max((e["_end_utc"] - e["_start_utc"] for e in entries), default=timedelta(0)),
+            "active": {i for i, e in enumerate(entries) if e.get("status") == "ACTIVE"},
+        }
+    return _sched_idx
+
+
+def _open_window_range(idx: Dict[str, Any], now_utc: datetime) -> range:
+    """Positions of entries whose window may contain now_utc (start <= now < start + max_window)."""
+    lo = bisect.bisect_left(idx["starts"], now_utc - idx["max_window"])
+    hi = bisect.bisect_right(idx["starts"], now_utc)
+    return range(lo, hi)
+
+
 def _first_active_entry(now_utc: datetime) -> Optional[Dict[str, Any]]:
-    for entry in cartridge_data.get("schedule", []):
-        try:
-            start = _parse_iso_utc(entry["datetime_start"])  # type: ignore
-            end = _parse_iso_utc(entry["datetime_end"])      # type: ignore
-        except Exception:
-            continue
-        status = entry.get("status")
-        if status == "ACTIVE" and start <= now_utc <= end:
+    idx = _schedule_index()
+    for i in _open_window_range(idx, now_utc):
+        entry = idx["entries"][i]
+        if entry.get("status") == "ACTIVE" and now_utc <= entry["_end_utc"]:
             return entry
     return None
 
 
 def handle_ok_button_dispense() -> None:
     now_utc = datetime.now(timezone.utc)
-    with state_lock:
+    with cartridge_lock:
         entry = _first_active_entry(now_utc)
         if not entry:
             # emit_event("no_active_dose_on_ok", {})
@@ -328,15 +463,17 @@ def handle_ok_button_dispense() -> None:
         m2 = int(mods.get("mod2", 0) or 0)
         m3 = int(mods.get("mod3", 0) or 0)
         m4 = int(mods.get("mod4", 0) or 0)
-        user_dispense_pills(m1, m2, m3, m4)
-        # Mark taken
+        # Mark taken before releasing the lock so a second press can't dispense twice
         entry["status"] = "TAKEN"
         entry["taken_at"] = now_utc.replace(microsecond=0).isoformat().replace("+00:00", "Z")
-        emit_event("dose_taken", {"entry": {k: entry.get(k) for k in ("day", "datetime_start", "datetime_end", "hash")}})
-        # After dispensing, go back to TIME screen
-        # send_serial('screen TIME')
-        global showing_take_pill
-        showing_take_pill = False
+        taken = {k: entry.get(k) for k in ("day", "datetime_start", "datetime_end", "hash")}
+        _schedule_changed()
+    showing_take_pill.clear()
+    # Serial I/O and events outside cartridge_lock
+    user_dispense_pills(m1, m2, m3, m4)
+    emit_event("dose_taken", {"entry": taken})
+    # After dispensing, go back to TIME screen
+    # send_serial('screen TIME')
 
 
 def schedule_tick() -> None:
@@ -346,64 +483,70 @@ def schedule_tick() -> None:
     - Transition ACTIVE -> MISSED when window ends and not taken (send missed message)
     - When no ACTIVE remains and we were showing TAKE_PILL, send screen TIME once
     """
-    global showing_take_pill
-
-    with state_lock:
-        sched = _get_schedule_list()
-        if not sched:
-            return
-        now_utc = datetime.now(timezone.utc)
-        any_active_now = False
-        for entry in sched:
-            try:
-                start = _parse_iso_utc(entry["datetime_start"])  # type: ignore
-                end = _parse_iso_utc(entry["datetime_end"])      # type: ignore
-            except Exception:
+    # Cheap lock-free check (dict.get is atomic) so an idle device skips the lock entirely
+    if not cartridge_data.get("schedule"):
+        return
+    now_utc = datetime.fromtimestamp(time.time(), timezone.utc)
+    started: List[Dict[str, Any]] = []
+    missed: List[tuple] = []  # (entry_end_iso, end_utc)
+    any_active_now = False
+    # Only status transitions happen under the lock; serial I/O and events follow below
+    with cartridge_lock:
+        idx = _schedule_index()
+        entries = idx["entries"]
+        active = idx["active"]
+
+        # Entering window: only entries whose window may contain now need checking
+        for i in _open_window_range(idx, now_utc):
+            entry = entries[i]
+            if (entry.get("status") or "DUE") in ("DUE", "UPCOMING") and now_utc <= entry["_end_utc"]:
+                entry["status"] = "ACTIVE"
+                active.add(i)
+                started.append({"start": entry["datetime_start"], "end": entry["datetime_end"]})
+
+        for i in sorted(active):
+            entry = entries[i]
+            # Taken (or otherwise resolved) since it became active
+            if entry.get("status") != "ACTIVE":
+                active.discard(i)
                 continue
-            status = entry.get("status") or "DUE"
 
-            # If already taken, skip
-            if status == "TAKEN":
+            # Window ended without being taken
+            if now_utc > entry["_end_utc"]:
+                entry["status"] = "MISSED"
+                active.discard(i)
+                missed.append((entry["datetime_end"], entry["_end_utc"]))
                 continue
 
-            pos = within_window(now_utc, start, end)
+            # Still in window
+            any_active_now = True
 
-            # Entering window
-            if status in ("DUE", "UPCOMING") and pos == 0:
-                entry["status"] = "ACTIVE"
-                emit_event("dose_window_started", {"start": entry["datetime_start"], "end": entry["datetime_end"]})
-                if not showing_take_pill:
-                    send_serial('screen TAKE_PILL')  # As per top docstring
-                    # Optionally play alarm once when a window starts
-                    if sound_alarm:
-                        try:
-                            sound_alarm.play(loops=-1)
-                        except Exception:
-                            pass
-                    showing_take_pill = True
-                any_active_now = True
-                continue
+        # Future windows: leave status as-is (DUE/UPCOMING)
 
-            # Still in window
-            if entry.get("status") == "ACTIVE" and pos == 0:
-                any_active_now = True
-                continue
+        if started or missed:
+            _schedule_changed()
 
-            # Window ended without being taken
-            if entry.get("status") == "ACTIVE" and pos == 1:
-                entry["status"] = "MISSED"
-                emit_event("dose_missed", {"end": entry["datetime_end"]})
-                send_serial(f"msg Dose missed! {end.astimezone().strftime('%H:%M')}")
-                # do not set showing_take_pill here; may still be other actives
-                continue
+    for payload in started:
+        emit_event("dose_window_started", payload)
+    if started and not showing_take_pill.is_set():
+        send_serial('screen TAKE_PILL')  # As per top docstring
+        # Optionally play alarm once when a window starts
+        if sound_alarm:
+            try:
+                sound_alarm.play(loops=-1)
+            except Exception:
+                pass
+        showing_take_pill.set()
 
-            # Future window
-            # Leave status as-is (DUE/UPCOMING)
+    for end_iso, end in missed:
+        emit_event("dose_missed", {"end": end_iso})
+        send_serial(f"msg Dose missed! {end.astimezone().strftime('%H:%M')}")
+        # do not set showing_take_pill here; may still be other actives
 
-        # If no ACTIVE windows remain and we were showing TAKE_PILL, return to TIME once
-        if not any_active_now and showing_take_pill:
-            send_serial('SCREEN TIME')
-            showing_take_pill = False
+    # If no ACTIVE windows remain and we were showing TAKE_PILL, return to TIME once
+    if not any_active_now and showing_take_pill.is_set():
+        send_serial('SCREEN TIME')
+        showing_take_pill.clear()
 
 
 # ---------------------------- Cartridges & dispensing ----------------------------
@@ -421,7 +564,10 @@ def load_cartridge_json(cid: str) -> Dict[str, Any]:
             except json.JSONDecodeError as e:  # pragma: no cover
                 print(f"Error parsing cartridge JSON: {e}")
                 return {}
-            cartridge_data = unpack_cartridge(raw) or raw
+            unpacked = unpack_cartridge(raw) or raw
+            with cartridge_lock:
+                cartridge_data = unpacked
+                _schedule_changed()
             print(f"Cartridge {cid} loaded!")
     else:
         print(f"Error: Path does not exist: {path}")
@@ -469,33 +615,34 @@ def unpack_cartridge(data: Dict[str, Any], start_offset: int = 0) -> Optional[Di
     else:
         pattern_length = 1
 
+    # Parse each template's times once and group templates by pattern day,
+    # so the per-day loop below only combines a date with pre-parsed times.
+    tpl_by_day: Dict[int, List[tuple]] = {}
+    for tpl in base_schedule:
+        t_start = dtime.fromisoformat(tpl.get("time_start", "00:00:00"))
+        t_end = dtime.fromisoformat(tpl.get("time_end", "23:59:59"))
+        tpl_by_day.setdefault(int(tpl.get("day", 1) or 1), []).append((tpl, t_start, t_end))
+
+    start_date_local = start_day_local.date()
     expanded: List[Dict[str, Any]] = []
     for abs_day in range(1, repeat_days + 1):
         pattern_day = ((abs_day - 1) % pattern_length) + 1
-        for tpl in base_schedule:
-            if int(tpl.get("day", 1) or 1) != pattern_day:
-                continue
+        entry_date_local = start_date_local + timedelta(days=abs_day - 1)
+        for tpl, t_start, t_end in tpl_by_day.get(pattern_day, ()):
             entry = dict(tpl)
             entry["day"] = abs_day
 
-            day_offset = abs_day - 1
-            entry_date_local = start_day_local + timedelta(days=day_offset)
-
-            t_start = entry.get("time_start", "00:00:00")
-            t_end = entry.get("time_end", "23:59:59")
-
-            dt_start_local = datetime.strptime(
-                f"{entry_date_local.strftime('%Y-%m-%d')} {t_start}", "%Y-%m-%d %H:%M:%S"
-            ).replace(tzinfo=local_tz)
-            dt_end_local = datetime.strptime(
-                f"{entry_date_local.strftime('%Y-%m-%d')} {t_end}", "%Y-%m-%d %H:%M:%S"
-            ).replace(tzinfo=local_tz)
+            dt_start_local = datetime.combine(entry_date_local, t_start, tzinfo=local_tz)
+            dt_end_local = datetime.combine(entry_date_local, t_end, tzinfo=local_tz)
 
             dt_start_utc = dt_start_local.astimezone(timezone.utc)
             dt_end_utc = dt_end_local.astimezone(timezone.utc)
 
             entry["datetime_start"] = dt_start_utc.replace(microsecond=0).isoformat().replace("+00:00", "Z")
             entry["datetime_end"] = dt_end_utc.replace(microsecond=0).isoformat().replace("+00:00", "Z")
+            # Cached for the scheduler; stripped from API responses
+            entry["_start_utc"] = dt_start_utc
+            entry["_end_utc"] = dt_end_utc
 
             # Status
             if now_utc < dt_start_utc:
@@ -511,6 +658,8 @@ def unpack_cartridge(data: Dict[str, Any], start_offset: int = 0) -> Optional[Di
 
             expanded.append(entry)
 
+    # Keep the schedule in start order (templates within a day may not be sorted)
+    expanded.sort(key=lambda e: e["_start_utc"])
     data["schedule"] = expanded
     data["prescription"] = prescription
     # Do not set activated here; caller may do it after successful activation
@@ -526,7 +675,7 @@ def user_dispense_pills(mod1: int, mod2: int, mod3: int, mod4: int) -> None:
 
     send_serial(f"drpall {mod1} {mod2} {mod3} {mod4}")
 
-    with state_lock:
+    with cartridge_lock:
         cart = cartridge_data.get("cartridge", {})
         for i, val in enumerate((mod1, mod2, mod3, mod4), start=1):
             mod_key = f"mod{i}"
@@ -535,15 +684,36 @@ def user_dispense_pills(mod1: int, mod2: int, mod3: int, mod4: int) -> None:
                 cart[mod_key]["quantity"] = max(0, qty - int(val))
         # save back
         cartridge_data["cartridge"] = cart
-        emit_event("pills_dispensed", {"cmd": f"drpall {mod1} {mod2} {mod3} {mod4}"})
+    emit_event("pills_dispensed", {"cmd": f"drpall {mod1} {mod2} {mod3} {mod4}"})
 
 
 # ---------------------------- Database (users) ----------------------------
 
+# One long-lived connection (autocommit); sqlite3 connections are not thread-safe,
+# so every statement goes through _db_lock.
+_db: Optional[sqlite3.Connection] = None
+_db_lock = threading.Lock()
+
+# Fixed SQL strings so sqlite3's per-connection statement cache always hits
+_USER_COLUMNS = "id, username, email, password_hash, is_admin, account_created, last_login"
+_SQL_FIND_BY_EMAIL = f"SELECT {_USER_COLUMNS} FROM users WHERE email = ?"
+_SQL_FIND_BY_ID = f"SELECT {_USER_COLUMNS} FROM users WHERE id = ?"
+_SQL_INSERT_USER = "INSERT INTO users(username, email, password_hash, is_admin, account_created) VALUES (?,?,?,?,?)"
+_SQL_UPDATE_LAST_LOGIN = "UPDATE users SET last_login = ? WHERE id = ?"
+
+
 def db_init() -> None:
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute(
+    global _db
+    _db = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    _db.row_factory = sqlite3.Row
+    with _db_lock:
+        _db.executescript(
             """
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA mmap_size=67108864;
+            PRAGMA cache_size=-8000;
             CREATE TABLE IF NOT EXISTS users (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 username TEXT NOT NULL,
@@ -552,44 +722,34 @@ def db_init() -> None:
                 is_admin INTEGER NOT NULL DEFAULT 0,
                 account_created TEXT NOT NULL,
                 last_login TEXT
-            )
+            );
             """
         )
-        conn.commit()
 
 
 def db_create_user(username: str, email: str, password: str, is_admin: int = 0) -> int:
     ph = generate_password_hash(password)
     now = datetime.utcnow().isoformat()
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.execute(
-            "INSERT INTO users(username, email, password_hash, is_admin, account_created) VALUES (?,?,?,?,?)",
-            (username, email, ph, is_admin, now),
-        )
-        conn.commit()
+    with _db_lock:
+        cur = _db.execute(_SQL_INSERT_USER, (username, email, ph, is_admin, now))
         return int(cur.lastrowid)
 
 
 def db_find_user_by_email(email: str) -> Optional[dict]:
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.row_factory = sqlite3.Row
-        cur = conn.execute("SELECT * FROM users WHERE email = ?", (email,))
-        row = cur.fetchone()
-        return dict(row) if row else None
+    with _db_lock:
+        row = _db.execute(_SQL_FIND_BY_EMAIL, (email,)).fetchone()
+    return dict(row) if row else None
 
 
 def db_find_user_by_id(uid: int) -> Optional[dict]:
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.row_factory = sqlite3.Row
-        cur = conn.execute("SELECT * FROM users WHERE id = ?", (uid,))
-        row = cur.fetchone()
-        return dict(row) if row else None
+    with _db_lock:
+        row = _db.execute(_SQL_FIND_BY_ID, (uid,)).fetchone()
+    return dict(row) if row else None
 
 
 def db_update_last_login(uid: int) -> None:
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute("UPDATE users SET last_login = ? WHERE id = ?", (datetime.utcnow().isoformat(), uid))
-        conn.commit()
+    with _db_lock:
+        _db.execute(_SQL_UPDATE_LAST_LOGIN, (datetime.utcnow().isoformat(), uid))
 
 
 # ---------------------------- Auth helpers ----------------------------
@@ -611,6 +771,34 @@ def require_admin() -> dict:
     return user
 
 
+def _not_modified(etag: str) -> Optional[Any]:
+    """304 response if the client's If-None-Match already holds etag, else None."""
+    if not request.if_none_match.contains(etag):
+        return None
+    resp = app.response_class(status=304)
+    resp.set_etag(etag)
+    return resp
+
+
+def _with_etag(resp: Any, etag: str) -> Any:
+    resp.set_etag(etag)
+    return resp
+
+
+def _body() -> Dict[str, Any]:
+    """Request body as a JSON object; {} when empty, 400 when malformed or not an object."""
+    raw = request.get_data(cache=False)
+    if not raw:
+        return {}
+    try:
+        data = _json_loads(raw)
+    except ValueError:
+        abort(400)
+    if not isinstance(data, dict):
+        abort(400)
+    return data
+
+
 # ---------------------------- Routes ----------------------------
 @app.route("/")
 def root_index():
@@ -621,7 +809,7 @@ def root_index():
 @app.route("/api/register", methods=["POST"])
 def register():
     require_admin()
-    data = request.get_json(force=True)
+    data = _body()
     username = (data.get("username") or "").strip() or data.get("email")
     email = (data.get("email") or "").strip().lower()
     password = data.get("password") or ""
@@ -636,7 +824,7 @@ def register():
 
 @app.route("/api/login", methods=["POST"])
 def login():
-    data = request.get_json(force=True)
+    data = _body()
     email = (data.get("email") or "").strip().lower()
     password = data.get("password") or ""
     user = db_find_user_by_email(email)
@@ -688,54 +876,68 @@ def me():
 @app.route("/api/cartridge")
 def get_cartridge():
     require_login()
-    global cartridge_data
-    with state_lock:
-        if cartridge_id == "0000000000000000":
-            send_serial("mem -r 0 f")
-            time.sleep(1)
-        return jsonify(cartridge_data.get("cartridge", {}))
+    if cartridge_id == "0000000000000000":
+        # Ask the device for its memory and wait (no lock held) until the reader parses it
+        _mem_loaded.clear()
+        send_serial("mem -r 0 f")
+        if ser is not None:  # in no-serial mode nothing will ever answer
+            _mem_loaded.wait(timeout=1.5)
+    with cartridge_lock:
+        snap = {k: dict(v) if isinstance(v, dict) else v for k, v in cartridge_data.get("cartridge", {}).items()}
+    return jsonify(snap)
 
 
 @app.route("/api/all_cartridge_data")
 def get_all_cartridge_data():
     require_login()
-    with state_lock:
-        return jsonify(cartridge_data)
+    with cartridge_lock:
+        snap = dict(cartridge_data)
+        snap["schedule"] = _snapshot_schedule()
+    return jsonify(snap)
 
 
 @app.route("/api/schedule")
 def get_schedule():
     require_login()
-    with state_lock:
-        return jsonify(cartridge_data.get("schedule", []))
+    # Polling clients with an up-to-date copy skip the snapshot and serialization
+    not_modified = _not_modified(f"{_BOOT_ID}-s{_schedule_version}")
+    if not_modified is not None:
+        return not_modified
+    with cartridge_lock:
+        etag = f"{_BOOT_ID}-s{_schedule_version}"
+        snap = _snapshot_schedule()
+    return _with_etag(jsonify(snap), etag)
 
 
 @app.route("/api/info")
 def get_info():
     require_login()
-    with state_lock:
-        return jsonify(cartridge_data.get("info", {}))
+    with cartridge_lock:
+        snap = dict(cartridge_data.get("info", {}))
+    return jsonify(snap)
 
 
 @app.route("/api/prescription")
 def get_prescription():
     require_login()
-    with state_lock:
-        return jsonify(cartridge_data.get("prescription", {}))
+    with cartridge_lock:
+        snap = dict(cartridge_data.get("prescription", {}))
+    return jsonify(snap)
 
 
 @app.route("/api/activate_cartridge", methods=["POST"])  # fixed: wrong keys and assignments
 def post_activate_cartridge():
     require_login()
-    data = request.get_json(force=True) or {}
+    data = _body()
     offset = int(data.get("offset") or 0)
     global cartridge_data
-    with state_lock:
+    with cartridge_lock:
         info = cartridge_data.get("info", {})
         # Expand/prepare schedule first
         expanded = unpack_cartridge(cartridge_data, start_offset=offset)
         if expanded is not None:
             cartridge_data = expanded
+            _schedule_changed()
         # Now mark as activated if not already
         if not bool(info.get("activated")):
             info["activated"] = True
@@ -754,15 +956,19 @@ def get_time():
 @app.route("/api/events")
 def get_events():
     require_login()
-    with state_lock:
-        return jsonify({"events": events})
+    # Read the version before copying so the ETag never claims newer data than sent
+    etag = f"{_BOOT_ID}-e{_events_version}"
+    not_modified = _not_modified(etag)
+    if not_modified is not None:
+        return not_modified
+    return _with_etag(jsonify({"events": list(events)}), etag)
 
 
 # Optional helper: dispense using an explicit cmd (mods map)
 @app.route("/api/dispense", methods=["POST"])
 def dispense():
     require_login()
-    data = request.get_json(force=True) or {}
+    data = _body()
     cmd = data.get("cmd") or {}
     if not isinstance(cmd, dict):
         return jsonify({"error": "cmd must be a dict with mod1..mod4 quantities"}), 400
@@ -775,7 +981,7 @@ def dispense():
 @app.route("/api/send_cmd", methods=["POST"])
 def admin_send_cmd():
     require_admin()
-    data = request.get_json(force=True) or {}
+    data = _body()
     cmd = (data.get("cmd") or "").strip()
     if not cmd:
         return jsonify({"error": "cmd required"}), 400
@@ -787,15 +993,14 @@ def admin_send_cmd():
 def admin_logs():
     require_admin()
     # Return as simple text; could be NDJSON
-    with state_lock:
-        body = "\n".join(serial_logs)
+    body = "\n".join(list(serial_logs))
     return app.response_class(body, mimetype="text/plain")
 
 
 @app.route("/api/play_sound", methods=["POST"])
 def admin_play_sound():
     require_admin()
-    data = request.get_json(force=True) or {}
+    data = _body()
     sound_name = (data.get("sound_name") or "").strip()
     if not sound_name:
         return jsonify({"error": "sound_name required"}), 400
@@ -829,23 +1034,49 @@ def startup() -> None:
 
     # Start background threads
     threading.Thread(target=serial_reader_thread, daemon=True).start()
-    threading.Thread(target=scheduler_thread, daemon=True).start()
-    threading.Thread(target=serial_heartbeat_thread, daemon=True).start()
+    threading.Thread(target=timer_thread, daemon=True).start()
 
     # This will update cartridge ID
     send_serial("mem -r 0 f")
 
 
-def scheduler_thread() -> None:
+# (name, callback, period in seconds) run by timer_thread
+TIMERS = [
+    ("Scheduler", schedule_tick, 1.0),  # 1 Hz tick is fine for demo
+    ("Heartbeat", heartbeat_send, 10.0),
+]
+
+
+def timer_thread() -> None:
+    """Run all periodic TIMERS from one thread, ordered by a min-heap of deadlines.
+    Deadlines are absolute (monotonic) so periods don't drift by the callback time;
+    periods missed during a stall are skipped, not caught up.
+    """
+    now = time.monotonic()
+    heap = [(now, i, name, cb, period) for i, (name, cb, period) in enumerate(TIMERS)]
+    heapq.heapify(heap)
     while True:
+        deadline, i, name, cb, period = heapq.heappop(heap)
+        time.sleep(max(0.0, deadline - time.monotonic()))
         try:
-            schedule_tick()
+            cb()
         except Exception as e:  # pragma: no cover
-            log_line(f"Scheduler error: {e}")
-        time.sleep(1)  # 1 Hz tick is fine for demo
+            log_line(f"{name} error: {e}")
+        deadline += period
+        now = time.monotonic()
+        if deadline < now:
+            # A callback stalled: skip the missed periods instead of replaying them as a burst
+            deadline += period * math.ceil((now - deadline) / period)
+        heapq.heappush(heap, (deadline, i, name, cb, period))
 
 
 if __name__ == "__main__":
     startup()
-    # Bind to 0.0.0.0 so it is reachable on the LAN; debug False for less noise
-    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)), debug=False)
+    # Bind to 0.0.0.0 so it is reachable on the LAN
+    port = int(os.environ.get("PORT", 5000))
+    if serve is not None and "--dev-server" not in sys.argv:
+        # waitress serves requests (incl. static files) on its own worker threads
+        serve(app, host="0.0.0.0", port=port, threads=4)
+    else:
+        # Dev server; debug False for less noise
+        app.run(host="0.0.0.0", port=port, debug=False)